@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import numpy as np
+
+from segments import load_segments, write_segments
+
+
+def coarsen_segments(data, max_length=0.2, max_angle=5.0, tol=1E-4):
+    """Merge runs of consecutive, nearly collinear steps into single segments.
+
+    Steps are grouped per (event_id, traj_id) in segment_id order. A merged
+    segment keeps only steps that are contiguous (each start within ``tol`` of
+    the previous end), share one pdg_id, and point within ``max_angle`` of the
+    first step of the segment. A step belongs to the ``max_length`` bucket of
+    path length its start lies in, so a merged segment is shorter than
+    ``max_length`` plus the length of its last step.
+
+    A merged segment runs from the first step's start to the last step's end,
+    with t0_start/t_start of the first step, t0_end/t_end of the last, and dE,
+    dx, n_electrons and n_photons summed. Midpoints and dEdx are recomputed.
+
+    Geometric error: every step of a merged segment is within 2*max_angle of
+    its chord, so no original step end point is farther than
+    ``(max_length + s) / 2 * sin(2 * max_angle)`` from the merged segment,
+    where ``s`` is the longest step (0.026 cm for the defaults and 0.1 cm steps).
+
+    Args:
+        data (np.ndarray): Array with segment_dtype fields.
+        max_length (float): Maximum path length of a merged segment in cm.
+        max_angle (float): Angle tolerance in degrees, within (0, 45).
+        tol (float): Largest gap in cm between consecutive steps of one run.
+
+    Returns:
+        np.ndarray: Merged segments, in the order of their first step in ``data``.
+
+    Raises:
+        ValueError: If ``max_length`` is not positive or ``max_angle`` is not
+            within (0, 45) degrees.
+    """
+    if not max_length > 0:
+        raise ValueError(f"max_length must be positive, got {max_length}.")
+    if not 0 < max_angle < 45:
+        raise ValueError(f"max_angle must be within (0, 45) degrees, got {max_angle}.")
+    if len(data) == 0:
+        return data.copy()
+    order = np.lexsort((data['segment_id'], data['traj_id'], data['event_id']))
+    d = data[order]
+    start = np.stack([d[f'{a}_start'] for a in 'xyz'], axis=1).astype(np.float64)
+    end = np.stack([d[f'{a}_end'] for a in 'xyz'], axis=1).astype(np.float64)
+    step = end - start
+    length = np.linalg.norm(step, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        direction = np.where(length[:, None] > 0, step / length[:, None], 0.)
+
+    # runs of contiguous steps of one particle
+    brk = np.ones(len(d), dtype=bool)
+    brk[1:] = (d['event_id'][1:] != d['event_id'][:-1]) \
+        | (d['traj_id'][1:] != d['traj_id'][:-1]) \
+        | (d['pdg_id'][1:] != d['pdg_id'][:-1]) \
+        | (np.linalg.norm(start[1:] - end[:-1], axis=1) > tol)
+
+    # path length buckets within each run, by the path length at a step's start
+    run = np.cumsum(brk) - 1
+    cum_end = np.cumsum(length)
+    cum_end -= (cum_end - length)[np.flatnonzero(brk)][run]
+    bucket = np.floor((cum_end - length) / max_length)
+    brk[1:] |= bucket[1:] != bucket[:-1]
+
+    # split at the first step deviating from its segment's first step until none does
+    cos_max = np.cos(np.radians(max_angle))
+    while True:
+        starts = np.flatnonzero(brk)
+        anchor = starts[np.cumsum(brk) - 1]
+        cos = np.einsum('ij,ij->i', direction, direction[anchor])
+        bad = np.flatnonzero((cos < cos_max) & (length > 0) & ~brk)
+        if len(bad) == 0:
+            break
+        _, first = np.unique(anchor[bad], return_index=True)
+        brk[bad[first]] = True
+
+    starts = np.flatnonzero(brk)
+    stops = np.append(starts[1:], len(d)) - 1
+    out = d[starts]
+    for a in 'xyz':
+        out[f'{a}_end'] = d[f'{a}_end'][stops]
+        out[a] = (out[f'{a}_start'].astype(np.float64) + out[f'{a}_end']) / 2.0
+    for name in ('t0', 't'):
+        out[f'{name}_end'] = d[f'{name}_end'][stops]
+        out[name] = (out[f'{name}_start'] + out[f'{name}_end']) / 2.0
+    for name in ('dE', 'dx', 'n_electrons', 'n_photons'):
+        out[name] = np.add.reduceat(d[name].astype(np.float64), starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['dEdx'] = out['dE'].astype(np.float64) / out['dx']
+    return out[np.argsort(order[starts])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge consecutive, nearly collinear steps of a segments file.")
+    parser.add_argument('input_file', help='Path to the input HDF5 file.')
+    parser.add_argument('output_file', help='Path to the output HDF5 file.')
+    parser.add_argument('--max_length', type=float, default=0.2, help='Maximum merged segment length in cm. Default: 0.2')
+    parser.add_argument('--max_angle', type=float, default=5.0, help='Angle tolerance in degrees. Default: 5')
+    args = parser.parse_args()
+    data = load_segments(args.input_file)
+    out = coarsen_segments(data, args.max_length, args.max_angle)
+    print(f"Coarsened {len(data)} segments to {len(out)}")
+    write_segments(args.output_file, out)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 
-import pandas as pd
 import json
 import argparse
 import os
-import h5py
 import numpy as np
 import zipfile
 
+from segments import load_segments
+
 def convert_hdf5_to_json(hdf5_file, output_prefix, event_ids=None):
     """
     Loads data from an HDF5 file (generated by convert.py), processes it,
@@ -15,11 +15,10 @@ def convert_hdf5_to_json(hdf5_file, output_prefix, event_ids=None):
     structured as prefix/data/{event_id}/{event_id}-pgun.json.
     """
     try:
-        with h5py.File(hdf5_file, 'r') as f:
-            if 'segments' not in f:
-                print(f"Error: 'segments' dataset not found in HDF5 file {hdf5_file}")
-                return
-            data = f['segments'][:]
+        data = load_segments(hdf5_file)
+    except KeyError:
+        print(f"Error: 'segments' dataset not found in HDF5 file {hdf5_file}")
+        return
     except FileNotFoundError:
         print(f"Error: HDF5 file not found at {hdf5_file}")
         return
@@ -27,72 +26,30 @@ def convert_hdf5_to_json(hdf5_file, output_prefix, event_ids=None):
         print(f"Error reading HDF5 file {hdf5_file}: {e}")
         return
 
-    # Reconstruct DataFrame structure based on convert.py's segment_dtype
-    # We need specific fields from the structured array 'data'
-
-    # Determine the dtype mapping for easier access (derived from convert.py)
-    segment_dtype_fields = [
-        ('t0_start', np.float64), ('t0_end', np.float64), ('t0', np.float64),
-        ('t_start', np.float64), ('t_end', np.float64), ('t', np.float64),
-        ('vertex_id', np.uint64),
-        ('event_id', np.uint32), ('segment_id', np.uint32), ('traj_id', np.uint32),
-        ('file_traj_id', np.uint32), ('n_electrons', np.uint32), ('pdg_id', np.int32),
-        ('pixel_plane', np.int32),
-        ('x_end', np.float32), ('y_end', np.float32), ('z_end', np.float32),
-        ('x_start', np.float32), ('y_start', np.float32), ('z_start', np.float32),
-        ('dx', np.float32), ('tran_diff', np.float32), ('long_diff', np.float32),
-        ('dEdx', np.float32), ('dE', np.float32), ('n_photons', np.float32),
-        ('x', np.float32), ('y', np.float32), ('z', np.float32),
-    ]
-
-    # Create a temporary Pandas DataFrame from the structured numpy array
-    df_dict = {name: data[name] for name, _ in segment_dtype_fields}
-
-    # Convert event_id to be 0-indexed if event_ids parameter was passed,
-    # assuming the structure expects 0-indexed events internally for filtering logic
-    # However, since we are only reading, we rely on 'event_id' field from HDF5.
-    df = pd.DataFrame(df_dict)
-
-    # The conversion logic in convert.py filters based on PDG_ID = |13| or |11|.
-    # We must re-apply this filter here, as the HDF5 file *might* contain other particles
-    # if it was generated without the specific muon/electron filter active, or if the user
-    # expects the JSON output to only contain these if the HDF5 was created broadly.
-    # Since convert.py filtered *before* writing to HDF5, we assume data here only
-    # contains muons/electrons OR we must filter based on the original assumption.
-
-    # Assuming the HDF5 was created only from Muons/Electrons steps as per convert.py:
-    # If event_ids is provided, it implies a specific filtering/mapping was done in convert.py
-    # that might affect how 'event_id' is interpreted if it wasn't the raw EventID.
+    # The conversion logic in convert.py filters based on PDG_ID = |13| or |11|
+    # before writing, so data here only contains muons/electrons.
 
     if event_ids is not None:
         # If event_ids was supplied to convert.py (meaning it mapped internal IDs to actual IDs),
-        # the 'event_id' column in HDF5 might be sequential 0, 1, 2... corresponding to event_ids[i].
-        # This path is complex without seeing the calling context from convert.py main().
-        # For simplicity and matching the JSON output structure, we assume 'event_id' in HDF5
-        # corresponds directly to the identifier used for directory naming, which was the original EventID
-        # or the mapped ID if eventid_as_runid logic was involved in *writing* to HDF5.
-
-        # If event_ids is passed here, we must filter the dataframe based on which event_id
-        # it corresponds to, but since we don't know the mapping logic from the HDF5 generation call,
-        # we rely solely on the 'event_id' field present in the data if possible.
-
-        # Fallback: If we are using event_ids, we assume we only want events present in that list.
-        # This might be too strict if event_ids was intended only for run ID mapping in the HDF5 context.
-        df = df[df['event_id'].isin(event_ids)]
-
-    # Since the HDF5 source logic in convert.py seems complex regarding event_id mapping,
-    # we rely on the 'event_id' field already present in the data, which should represent
-    # the EventID used for grouping in the original script.
+        # the 'event_id' field already holds the mapped ID used for directory naming.
+        # We only keep events present in that list.
+        data = data[np.isin(data['event_id'], event_ids)]
 
-    if df.empty:
+    if len(data) == 0:
         print(f"No relevant event data found in {hdf5_file}.")
         return
 
     # Calculate center coordinates (x, y, z) - these fields ('x', 'y', 'z') are already calculated
     # and present in the HDF5 structure from convert.py. We use them directly.
 
-    # Group by EventID to create one JSON object per event
-    grouped = df.groupby('event_id')
+    # Group by EventID to create one JSON object per event; a stable sort keeps
+    # the step order inside each event. Only the columns written out are
+    # gathered, so a memory-mapped input is never copied whole.
+    order = np.argsort(data['event_id'], kind='stable')
+    event_id_sorted = data['event_id'][order]
+    unique_ids, starts = np.unique(event_id_sorted, return_index=True)
+    columns = [np.split(data[axis][order], starts[1:]) for axis in 'xyz']
+    grouped = zip(unique_ids, zip(*columns))
 
     # Static requirements from the original implementation
     run_no = "0"
@@ -102,18 +59,18 @@ def convert_hdf5_to_json(hdf5_file, output_prefix, event_ids=None):
     cluster_id_val = 1
     real_cluster_id_val = 1
 
-    for event_id, group in grouped:
+    for event_id, (x, y, z) in grouped:
         # Prepare the JSON structure for this event
         event_json = {
             "runNo": run_no,
             "subRunNo": sub_run_no,
             "eventNo": str(event_id),
             # Use pre-calculated 'x', 'y', 'z' from HDF5 structure
-            "x": group['x'].tolist(),
-            "y": group['y'].tolist(),
-            "z": group['z'].tolist(),
-            "cluster_id": [cluster_id_val] * len(group),
-            "real_cluster_id": [real_cluster_id_val] * len(group),
+            "x": x.tolist(),
+            "y": y.tolist(),
+            "z": z.tolist(),
+            "cluster_id": [cluster_id_val] * len(x),
+            "real_cluster_id": [real_cluster_id_val] * len(x),
             "geom": geom,
             "type": type_str,
         }
@@ -1,51 +1,13 @@
 #!/usr/bin/env python3
 
 import numpy as np
-import h5py
 import argparse
 import os
 import re
 
-
-# Define the structured dtype
-segment_dtype = np.dtype([
-    # 8-byte float64
-    ('t0_start',     np.float64),  # 8 bytes
-    ('t0_end',       np.float64),
-    ('t0',           np.float64),
-    ('t_start',      np.float64),
-    ('t_end',        np.float64),
-    ('t',            np.float64),
-
-    # 8-byte uint64
-    ('vertex_id',    np.uint64),
-
-    # 4-byte uint32 / int32
-    ('event_id',     np.uint32),
-    ('segment_id',   np.uint32),
-    ('traj_id',      np.uint32),
-    ('file_traj_id', np.uint32),
-    ('n_electrons',  np.uint32),
-    ('pdg_id',       np.int32),
-    ('pixel_plane',  np.int32),
-
-    # 4-byte float32
-    ('x_end',        np.float32),
-    ('y_end',        np.float32),
-    ('z_end',        np.float32),
-    ('x_start',      np.float32),
-    ('y_start',      np.float32),
-    ('z_start',      np.float32),
-    ('dx',           np.float32),
-    ('tran_diff',    np.float32),
-    ('long_diff',    np.float32),
-    ('dEdx',         np.float32),
-    ('dE',           np.float32),
-    ('n_photons',    np.float32),
-    ('x',            np.float32),
-    ('y',            np.float32),
-    ('z',            np.float32),
-], align=True)
+from segments import build_event_index, combine_summaries, compact_dtype, compact_layout, \
+    event_index_dtype, event_summary, event_summary_dtype, iter_chunks, join_event_index, \
+    read_compact_layout, segment_dtype, to_compact, write_compact_layout
 
 
 def filter_file_list(infiles: list[str], pattern: str) -> list[str]:
@@ -69,26 +31,232 @@ def filter_file_list(infiles: list[str], pattern: str) -> list[str]:
     return filtered_files
 
 
+def manifest_dtype():
+    """Dtype of the 'merge_manifest' dataset, one row per merged input."""
+    import h5py
+
+    return np.dtype([
+        ('path',     h5py.string_dtype()),  # absolute path of the input
+        ('size',     np.uint64),            # file size in bytes when merged
+        ('mtime',    np.float64),           # modification time when merged
+        ('track_id', np.uint64),            # event_id captured from the file name
+        ('stride',   np.uint64),
+        ('start',    np.uint64),            # [start, stop) rows in 'segments'
+        ('stop',     np.uint64),
+    ])
+
+
+def read_manifest(output_file):
+    """Return the manifest and the segments layout of an existing merged file.
+
+    Returns:
+        tuple[np.ndarray, int, dict or None]: Manifest rows, the stride the
+        file was merged with, and its compact layout (None if full profile).
+
+    Raises:
+        ValueError: If the file cannot be appended to.
+    """
+    import h5py
+
+    with h5py.File(output_file, 'r') as h5f:
+        if 'merge_manifest' not in h5f or 'segments' not in h5f:
+            raise ValueError(f"{output_file} has no merge manifest; it was not written by merge.py --append.")
+        if h5f['segments'].maxshape[0] is not None:
+            raise ValueError(f"'segments' in {output_file} is not resizable; rebuild it with --append.")
+        manifest = h5f['merge_manifest'][:]
+        stride = int(h5f['merge_manifest'].attrs['stride'])
+    return manifest, stride, read_compact_layout(output_file)
+
+
+def max_event_id(path, chunk_rows=1 << 20):
+    """Largest event_id of the segments of ``path``, -1 if it has none.
+
+    Uses the 'event_summary' table if the file has one, otherwise reads only
+    the event_id column.
+    """
+    import h5py
+
+    with h5py.File(path, 'r') as h5f:
+        if 'event_summary' in h5f:
+            event_id = h5f['event_summary'].fields('event_id')[:]
+            return int(event_id.max()) if len(event_id) else -1
+        ds = h5f['segments']
+        g4_max = -1
+        for start in range(0, ds.shape[0], chunk_rows):
+            g4_max = max(g4_max, int(ds.fields('event_id')[start:start+chunk_rows].max()))
+    return g4_max
+
+
+def new_inputs(filtered_files, manifest, stride, check=True):
+    """Return the inputs not yet in ``manifest``, after checking for event_id collisions.
+
+    Nothing is written; every check happens before the output is touched.
+    With ``check`` false (a plain merge), collisions are not looked for.
+
+    Raises:
+        ValueError: If a merged input changed since it was merged, two inputs
+            share a track event_id, or an input holds a Geant4 event_id that
+            does not fit into the stride.
+    """
+    paths = [p.decode() if isinstance(p, bytes) else p for p in manifest['path']]
+    merged = dict(zip(paths, manifest))
+    taken = dict(zip(manifest['track_id'].tolist(), paths))
+    todo = []
+    for f in filtered_files:
+        path = os.path.abspath(f[0])
+        st = os.stat(path)
+        if path in merged:
+            row = merged[path]
+            if row['size'] == st.st_size and row['mtime'] == st.st_mtime:
+                print(f"Skipping already merged file: {f[0]}")
+                continue
+            raise ValueError(f"File {f[0]} changed since it was merged; rebuild the output without --append.")
+        if check:
+            if f[1] in taken:
+                raise ValueError(f"event_id {f[1]} of {f[0]} collides with {taken[f[1]]}.")
+            taken[f[1]] = path
+            g4_max = max_event_id(f[0])
+            if g4_max >= stride:
+                raise ValueError(f"File {f[0]} has event_id {g4_max} >= stride {stride}; "
+                                 f"it would collide with event_id {f[1] + 1}.")
+        todo.append((f[0], f[1], path, st.st_size, st.st_mtime))
+    return todo
+
+
+def merge_segments(filtered_files, output_file, stride, compact=False, append=False,
+                   summary=False):
+    """Stream the segments of each input into one output file.
+
+    Inputs are read block by block (memory-mapped when contiguous) and written
+    straight into the output dataset, so neither an input nor the merged result
+    is ever held in memory as a whole. A 'merge_manifest' dataset records every
+    merged input, and an 'event_index' dataset the row range of every event.
+
+    With ``append`` the output is created with a resizable 'segments' dataset,
+    or, if it exists, only the inputs missing from its manifest are appended.
+
+    Args:
+        filtered_files (list[tuple[str, int]]): Input paths and their event_id, as returned by filter_file_list.
+        output_file (str): Path to the output merged HDF5 file.
+        stride (int): event_id_new = event_id_track * stride + event_id_g4.
+        compact (bool): Write the compact storage profile; its layout is decided by a first pass over the inputs.
+        append (bool): Top up an existing output instead of rebuilding it.
+        summary (bool): Also write an 'event_summary' table, summarized while streaming. An appended output keeps its table up to date.
+    """
+    import h5py
+
+    for f in filtered_files:
+        with h5py.File(f[0], 'r') as h5f:
+            if 'segments' not in h5f:
+                raise KeyError(f"Warning: File {f} does not contain 'segments' dataset.")
+
+    exists = append and os.path.exists(output_file)
+    manifest, layout = np.zeros(0, dtype=manifest_dtype()), None
+    if exists:
+        manifest, merged_stride, layout = read_manifest(output_file)
+        if merged_stride != stride:
+            raise ValueError(f"{output_file} was merged with stride {merged_stride}, not {stride}.")
+        with h5py.File(output_file, 'r') as h5f:
+            has_summary = 'event_summary' in h5f
+        if summary and not has_summary:
+            raise ValueError(f"{output_file} was merged without --summary.")
+        summary = has_summary
+        if compact and layout is None:
+            raise ValueError(f"{output_file} was merged without --compact.")
+    # a plain merge accepts colliding event_ids as it always did; an appended
+    # file must stay consistent with its manifest
+    todo = new_inputs(filtered_files, manifest, stride, check=append)
+    if exists and layout is not None:
+        # validate the new inputs against the stored layout before writing
+        for f in todo:
+            for data in iter_chunks(f[0]):
+                to_compact(data, layout)
+    elif compact and not exists:
+        layout = compact_layout(data for f in todo for data in iter_chunks(f[0]))
+
+    sizes = []
+    for f in todo:
+        with h5py.File(f[0], 'r') as h5f:
+            sizes.append(h5f['segments'].shape[0])
+    if exists and not todo:
+        print(f"Nothing new to merge into {output_file}")
+        return
+
+    with h5py.File(output_file, 'a' if exists else 'w') as h5out:
+        if exists:
+            out = h5out['segments']
+            info = h5out['merge_manifest']
+            # drop rows of an interrupted append that never reached the manifest
+            pos = int(manifest['stop'].max()) if len(manifest) else 0
+            out.resize((pos + sum(sizes),))
+            if summary:
+                table = h5out['event_summary']
+                keep = np.isin(table[:]['event_id'] // stride, manifest['track_id'])
+                table.resize((int(np.count_nonzero(keep)),))
+            index = h5out.get('event_index')
+            if index is not None:
+                index.resize((int(np.count_nonzero(index[:]['stop'] <= pos)),))
+        else:
+            dtype = segment_dtype if layout is None else compact_dtype(layout)
+            if append:
+                out = h5out.create_dataset('segments', shape=(sum(sizes),), maxshape=(None,),
+                                           chunks=(1 << 14,), dtype=dtype)
+            else:
+                out = h5out.create_dataset('segments', shape=(sum(sizes),), dtype=dtype)
+            if layout is not None:
+                write_compact_layout(out, layout)
+            info = h5out.create_dataset('merge_manifest', shape=(0,), maxshape=(None,),
+                                        dtype=manifest_dtype())
+            info.attrs['stride'] = stride
+            index = h5out.create_dataset('event_index', shape=(0,), maxshape=(None,),
+                                         dtype=event_index_dtype)
+            if summary:
+                table = h5out.create_dataset('event_summary', shape=(0,), maxshape=(None,),
+                                             dtype=event_summary_dtype)
+            pos = 0
+        for f in todo:
+            print(f"Processing file: {f[0]} with event_id {f[1]}")
+            start = pos
+            summaries, blocks = [], []
+            for data in iter_chunks(f[0]):
+                data = np.array(data)
+                data['event_id'] = f[1] * stride + data['event_id']
+                out[pos:pos+len(data)] = data if layout is None else to_compact(data, layout)
+                blocks.append(build_event_index(data['event_id'], pos))
+                pos += len(data)
+                if summary:
+                    summaries.append(event_summary(data))
+            if index is not None:
+                rows = join_event_index(blocks)
+                index.resize((index.shape[0] + len(rows),))
+                index[index.shape[0] - len(rows):] = rows
+            if summary:
+                # events of different inputs never share an event_id
+                rows = combine_summaries(summaries)
+                table.resize((table.shape[0] + len(rows),))
+                table[table.shape[0] - len(rows):] = rows
+            row = np.zeros(1, dtype=info.dtype)
+            row['path'], row['size'], row['mtime'] = f[2], f[3], f[4]
+            row['track_id'], row['stride'] = f[1], stride
+            row['start'], row['stop'] = start, pos
+            info.resize((info.shape[0] + 1,))
+            info[-1] = row[0]
+
+
 def main():
     parser = argparse.ArgumentParser(description="Merge multiple HDF5 files into a single file.")
     parser.add_argument('-n', help='stride for event_id; event_id_new = event_id_track * n + event_id_g4', type=int, default=100)
     parser.add_argument('--pat', help='Regular expression pattern that file names must match, with one capturing group for event_id. Default: "^.*_event_id__(\\d+).*\\.hdf5$"', type=str, default="^.*_event_id__(\\d+).*\\.hdf5$")
+    parser.add_argument('--compact', help='Write the compact storage profile: constant columns become attributes and derivable columns are not stored.', action='store_true')
+    parser.add_argument('--append', help='Append to an existing output written with --append, skipping inputs listed in its merge manifest.', action='store_true')
+    parser.add_argument('--summary', help="Also write a per-event 'event_summary' table.", action='store_true')
     parser.add_argument('output_file', help='Path to the output merged HDF5 file.')
     parser.add_argument('input_files', nargs='+', help='List of input HDF5 files to merge.')
     args = parser.parse_args()
     pattern = "^.*_event_id__(\\d+).*\\.hdf5$"
     filtered_files = files = filter_file_list(args.input_files, args.pat)
-    df = np.array([], dtype=segment_dtype)
-    for f in filtered_files:
-        print(f"Processing file: {f[0]} with event_id {f[1]}")
-        with h5py.File(f[0], 'r') as h5f:
-            if 'segments' not in h5f:
-                raise KeyError(f"Warning: File {f} does not contain 'segments' dataset.")
-            data = h5f['segments'][:]
-            data['event_id'] = f[1] * args.n + data['event_id']
-            df = np.concatenate((df, data), axis=0)
-    with h5py.File(args.output_file, 'w') as f:
-        f.create_dataset('segments', data=df)
+    merge_segments(filtered_files, args.output_file, args.n, compact=args.compact,
+                   append=args.append, summary=args.summary)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from segments import build_event_index, compact_dtype, compact_layout, iter_chunks, \
+    join_event_index, segment_dtype, to_compact, write_compact_layout
+
+
+def arrow_schema():
+    """Arrow schema with the exact field types of segment_dtype."""
+    import pyarrow as pa
+
+    return pa.schema([(name, pa.from_numpy_dtype(segment_dtype[name]))
+                      for name in segment_dtype.names])
+
+
+def segments_to_table(data):
+    """Arrow table of a segment_dtype array, one contiguous buffer per column."""
+    import pyarrow as pa
+
+    return pa.Table.from_arrays([pa.array(np.ascontiguousarray(data[name]))
+                                 for name in segment_dtype.names], schema=arrow_schema())
+
+
+def table_to_segments(table):
+    """segment_dtype array of an Arrow table or record batch."""
+    data = np.empty(table.num_rows, dtype=segment_dtype)
+    for name in segment_dtype.names:
+        data[name] = table.column(name).to_numpy(zero_copy_only=False)
+    return data
+
+
+partitioning_file = '_partitioning.json'
+
+
+def read_events_per_partition(src):
+    """events_per_partition an exported directory was written with."""
+    with open(os.path.join(src, partitioning_file)) as f:
+        return json.load(f)['events_per_partition']
+
+
+def predicate_expression(pdg=None, event_range=None, event_ids=None, box=None,
+                         time_window=None, events_per_partition=None):
+    """Arrow filter with the meaning of select_segments.segment_mask.
+
+    Parquet row-group statistics let a scan with this filter skip the row
+    groups that cannot match. Given the ``events_per_partition`` of the export
+    (see :func:`read_events_per_partition`), event predicates also select
+    event_block partitions, so other partitions are not opened at all.
+    """
+    import pyarrow.dataset as pads
+
+    field = pads.field
+    terms = []
+    if pdg is not None:
+        terms.append(field('pdg_id').isin(list(pdg)))
+    if event_range is not None:
+        terms.append((field('event_id') >= event_range[0]) & (field('event_id') < event_range[1]))
+        if events_per_partition is not None:
+            terms.append((field('event_block') >= event_range[0] // events_per_partition)
+                         & (field('event_block') <= (event_range[1] - 1) // events_per_partition))
+    if event_ids is not None:
+        terms.append(field('event_id').isin(list(event_ids)))
+        if events_per_partition is not None:
+            blocks = sorted(set(int(e) // events_per_partition for e in event_ids))
+            terms.append(field('event_block').isin(blocks))
+    if box is not None:
+        for i, axis in enumerate('xyz'):
+            for point in ('start', 'end'):
+                v = field(f'{axis}_{point}')
+                terms.append((v >= box[2*i]) & (v <= box[2*i+1]))
+    if time_window is not None:
+        terms.append((field('t0_end') >= time_window[0]) & (field('t0_start') < time_window[1]))
+    expression = None
+    for term in terms:
+        expression = term if expression is None else expression & term
+    return expression
+
+
+def export_parquet(path, out_dir, events_per_partition=1000, row_group_rows=1 << 17,
+                   compression='zstd', dataset_name='segments', max_buffered_rows=1 << 20,
+                   max_open_files=64):
+    """Write a segments dataset as Parquet partitioned by event_id range.
+
+    Rows go to ``out_dir/event_block=<event_id // events_per_partition>/part-<n>.parquet``
+    in input order, buffered per partition into row groups of ``row_group_rows``.
+    The input is streamed: when more than ``max_buffered_rows`` rows are
+    buffered over all partitions, the largest buffers are written out, and at
+    most ``max_open_files`` writers are kept open, closing the least recently
+    used one and continuing its partition in a new numbered file.
+    pdg_id is dictionary encoded; all other columns are plain with statistics.
+    ``events_per_partition`` is recorded in ``_partitioning.json``.
+
+    Raises:
+        FileExistsError: If ``out_dir`` exists and is not empty.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if os.path.isdir(out_dir) and os.listdir(out_dir):
+        raise FileExistsError(f"Output directory {out_dir} is not empty.")
+    os.makedirs(out_dir, exist_ok=True)
+    # files starting with '_' are skipped by pyarrow dataset discovery
+    with open(os.path.join(out_dir, partitioning_file), 'w') as f:
+        json.dump({'events_per_partition': events_per_partition}, f)
+    schema = arrow_schema()
+    writers, buffers, n_buffered, n_files = {}, {}, {}, {}
+
+    def flush(block):
+        writer = writers.pop(block, None)
+        if writer is None:
+            if len(writers) >= max_open_files:
+                writers.pop(next(iter(writers))).close()
+            part_dir = os.path.join(out_dir, f'event_block={block:010d}')
+            os.makedirs(part_dir, exist_ok=True)
+            n = n_files.get(block, 0)
+            n_files[block] = n + 1
+            writer = pq.ParquetWriter(os.path.join(part_dir, f'part-{n:05d}.parquet'), schema,
+                                      compression=compression, use_dictionary=['pdg_id'])
+        writers[block] = writer  # most recently used last
+        writer.write_table(pa.concat_tables(buffers.pop(block)), row_group_size=row_group_rows)
+        del n_buffered[block]
+
+    try:
+        for data in iter_chunks(path, dataset_name, row_group_rows):
+            blocks = data['event_id'] // events_per_partition
+            for block in np.unique(blocks).tolist():
+                rows = data[blocks == block]
+                buffers.setdefault(block, []).append(segments_to_table(rows))
+                n_buffered[block] = n_buffered.get(block, 0) + len(rows)
+                if n_buffered[block] >= row_group_rows:
+                    flush(block)
+            if sum(n_buffered.values()) > max_buffered_rows:
+                for block in sorted(n_buffered, key=n_buffered.get, reverse=True):
+                    flush(block)
+                    if sum(n_buffered.values()) <= max_buffered_rows // 2:
+                        break
+        for block in list(buffers):
+            flush(block)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def open_dataset(src):
+    """pyarrow dataset over an exported directory, with its event_block partitions."""
+    import pyarrow.dataset as pads
+
+    return pads.dataset(src, format='parquet', partitioning='hive')
+
+
+def load_dataframe(src, columns=None, filter=None):
+    """pandas DataFrame of an exported directory.
+
+    Numeric columns are handed over from Arrow without an extra copy
+    (``split_blocks``/``self_destruct``), so the frame costs one copy of the
+    selected data rather than two.
+    """
+    table = open_dataset(src).to_table(columns=columns or list(segment_dtype.names),
+                                       filter=filter)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def import_parquet(src, h5out, filter=None, compact=False, dataset_name='segments'):
+    """Write the rows of an exported directory passing ``filter`` to a new HDF5 file.
+
+    Record batches are streamed into a preallocated dataset, indexed by
+    event as they go; with ``compact`` a first pass decides the compact layout.
+    """
+    import h5py
+
+    dataset = open_dataset(src)
+    columns = list(segment_dtype.names)
+
+    def batches():
+        for batch in dataset.to_batches(columns=columns, filter=filter):
+            if batch.num_rows:
+                yield table_to_segments(batch)
+
+    n_rows = dataset.count_rows(filter=filter)
+    layout = compact_layout(batches()) if compact else None
+    with h5py.File(h5out, 'w') as f:
+        dtype = segment_dtype if layout is None else compact_dtype(layout)
+        out = f.create_dataset(dataset_name, shape=(n_rows,), dtype=dtype)
+        if layout is not None:
+            write_compact_layout(out, layout)
+        pos, index = 0, []
+        for data in batches():
+            out[pos:pos+len(data)] = data if layout is None else to_compact(data, layout)
+            index.append(build_event_index(data['event_id'], pos))
+            pos += len(data)
+        f.create_dataset('event_index', data=join_event_index(index))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export segments HDF5 to partitioned Parquet, or import it back.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    exp = sub.add_parser('export', help='HDF5 to Parquet.')
+    exp.add_argument('input_file', help='Path to the input HDF5 file.')
+    exp.add_argument('output_dir', help='Output directory, must be empty or missing.')
+    exp.add_argument('--events_per_partition', type=int, default=1000, help='event_id range per partition. Default: 1000')
+    exp.add_argument('--row_group_rows', type=int, default=1 << 17, help='Rows per Parquet row group. Default: 131072')
+    exp.add_argument('--max_buffered_rows', type=int, default=1 << 20, help='Rows buffered over all partitions before the largest are written. Default: 1048576')
+    exp.add_argument('--max_open_files', type=int, default=64, help='Parquet files kept open at once. Default: 64')
+    imp = sub.add_parser('import', help='Parquet to HDF5.')
+    imp.add_argument('input_dir', help='Directory written by export.')
+    imp.add_argument('output_file', help='Path to the output HDF5 file.')
+    imp.add_argument('--pdg', type=int, nargs='+', help='Accepted pdg_id values.')
+    imp.add_argument('--events', type=int, nargs=2, metavar=('FIRST', 'LAST'),
+                     help='Accepted event_id range [FIRST, LAST).')
+    imp.add_argument('--compact', action='store_true', help='Write the compact storage profile.')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_parquet(args.input_file, args.output_dir, args.events_per_partition,
+                       args.row_group_rows, max_buffered_rows=args.max_buffered_rows,
+                       max_open_files=args.max_open_files)
+    else:
+        import_parquet(args.input_dir, args.output_file,
+                       predicate_expression(pdg=args.pdg, event_range=args.events,
+                                            events_per_partition=read_events_per_partition(args.input_dir)),
+                       compact=args.compact)
+
+
+if __name__ == '__main__':
+    main()
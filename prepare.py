@@ -1,15 +1,8 @@
-import h5py
 import numpy as np
 import sys
 import os
 
-def load_dataset(path, dataset_name):
-    """
-    Load structured array from an HDF5 file.
-    """
-    with h5py.File(path, 'r') as f:
-        data = f[dataset_name][:]
-    return data
+from segments import load_dataset
 
 
 def compute_endpoints_and_direction(points):
@@ -0,0 +1,701 @@
+"""Shared schema, geometry and HDF5 helpers for the segments pipeline.
+
+Only numpy is imported at module load. pandas and h5py are imported inside
+the functions that need them, so scripts that never parse CSV do not pay
+for pandas and ``--help`` does not pay for either.
+"""
+
+import contextlib
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+# Define the structured dtype
+segment_dtype = np.dtype([
+    # 8-byte float64
+    ('t0_start',     np.float64),  # 8 bytes
+    ('t0_end',       np.float64),
+    ('t0',           np.float64),
+    ('t_start',      np.float64),
+    ('t_end',        np.float64),
+    ('t',            np.float64),
+
+    # 8-byte uint64
+    ('vertex_id',    np.uint64),
+
+    # 4-byte uint32 / int32
+    ('event_id',     np.uint32),
+    ('segment_id',   np.uint32),
+    ('traj_id',      np.uint32),
+    ('file_traj_id', np.uint32),
+    ('n_electrons',  np.uint32),
+    ('pdg_id',       np.int32),
+    ('pixel_plane',  np.int32),
+
+    # 4-byte float32
+    ('x_end',        np.float32),
+    ('y_end',        np.float32),
+    ('z_end',        np.float32),
+    ('x_start',      np.float32),
+    ('y_start',      np.float32),
+    ('z_start',      np.float32),
+    ('dx',           np.float32),
+    ('tran_diff',    np.float32),
+    ('long_diff',    np.float32),
+    ('dEdx',         np.float32),
+    ('dE',           np.float32),
+    ('n_photons',    np.float32),
+    ('x',            np.float32),
+    ('y',            np.float32),
+    ('z',            np.float32),
+], align=True)
+
+# hard coded TPC borders and directions
+tpc_borders = [
+  [3.069, 33.34125, -62.076, 62.076, 2.462, 64.538],
+  [33.65875, 63.931, -62.076, 62.076, 2.462, 64.538],
+  [3.069, 33.34125, -62.076, 62.076, -64.538, -2.462],
+  [33.65875, 63.931, -62.076, 62.076, -64.538, -2.462],
+  [-63.931, -33.65875, -62.076, 62.076, 2.462, 64.538],
+  [-33.34125, -3.069, -62.076, 62.076, 2.462, 64.538],
+  [-63.931, -33.65875, -62.076, 62.076, -64.538, -2.462],
+  [-33.34125, -3.069, -62.076, 62.076, -64.538, -2.462]
+] # xmin, max, ymin, ymax, zmin, zmax
+tpc_direction = [-1, 1, -1, 1, -1, 1, -1, 1]
+
+# row ranges [start, stop) of the segments dataset holding each event
+event_index_dtype = np.dtype([
+    ('event_id', np.uint32),
+    ('start',    np.uint64),
+    ('stop',     np.uint64),
+])
+
+# per-event totals written next to the segments by --summary
+event_summary_dtype = np.dtype([
+    ('event_id',   np.uint32),
+    ('n_segments', np.uint64),
+    ('n_muon',     np.uint64),
+    ('n_electron', np.uint64),
+    ('dE',         np.float64),
+    ('dx',         np.float64),
+    ('x_min',      np.float32),
+    ('x_max',      np.float32),
+    ('y_min',      np.float32),
+    ('y_max',      np.float32),
+    ('z_min',      np.float32),
+    ('z_max',      np.float32),
+    ('t0_min',     np.float64),
+    ('t0_max',     np.float64),
+])
+
+# compact storage profile: columns convert_csv_to_hdf5 always fills with one
+# value are kept as dataset attributes, columns derivable from others are not
+# stored, and the rest is packed without alignment padding
+compact_constant_fields = ('t_start', 't_end', 't', 'n_electrons',
+                           'pixel_plane', 'tran_diff', 'long_diff', 'n_photons')
+compact_derived_fields = ('file_traj_id', 't0', 'x', 'y', 'z', 'dEdx')
+
+# column names of the MuonSteps ntuple written by MyRunAction
+csv_names = ['EventID', 'TrackID', 'StepID',
+             'x_start(cm)', 'y_start(cm)', 'z_start(cm)', 't0_start(us)',
+             'x_end(cm)', 'y_end(cm)', 'z_end(cm)', 't0_end(us)',
+             'Edep(MeV)', 'KineticE(MeV)', 'StepLength(cm)',
+             'PDG_ID', 'ParentID', 'ProcessName']
+
+
+def is_row_all_strings(row):
+    return all(isinstance(x, str) and not x.strip().isdigit() for x in row)
+
+
+def read_steps_csv(csv_file, pdg_codes=None):
+    """Read a MuonSteps CSV into a DataFrame, with or without a header row.
+
+    Args:
+        csv_file (str): Path to the CSV file.
+        pdg_codes (iterable[int], optional): Keep only rows whose |PDG_ID| is
+            in this set.
+    """
+    import pandas as pd
+
+    try:
+        first_row = pd.read_csv(csv_file, nrows=1, comment='#', names=None)\
+                      .iloc[0].tolist()
+    except (pd.errors.EmptyDataError, IndexError):
+        # a worker thread that processed no event writes a header-only shard
+        return pd.DataFrame(columns=csv_names)
+    names = None if is_row_all_strings(first_row) else csv_names
+    if pdg_codes is None:
+        return pd.read_csv(csv_file, comment='#', names=names)
+    # filter block by block so rejected particles are never held in memory
+    pdg_codes = list(pdg_codes)
+    reader = pd.read_csv(csv_file, comment='#', names=names, chunksize=1 << 20)
+    return pd.concat([df[df['PDG_ID'].abs().isin(pdg_codes)] for df in reader],
+                     ignore_index=True)
+
+
+def expand_csv_shards(csv_file):
+    """Return the CSV files that make up ``csv_file``.
+
+    ``csv_file`` may be a single file, a glob, or the name Geant4 would use
+    in sequential mode; in the latter case the per-thread shards written by a
+    multi-threaded run (``<name>_t0.csv``, ``<name>_t1.csv``, ...) are used.
+    Shards are ordered by thread index.
+
+    Raises:
+        FileNotFoundError: If nothing matches.
+    """
+    if glob.has_magic(csv_file):
+        paths = glob.glob(csv_file)
+    elif os.path.exists(csv_file):
+        return [csv_file]
+    else:
+        root, ext = os.path.splitext(csv_file)
+        shard = re.compile(re.escape(os.path.basename(root)) + r'_t\d+'
+                           + re.escape(ext))
+        paths = [p for p in glob.glob(glob.escape(root) + '_t*' + ext)
+                 if shard.fullmatch(os.path.basename(p))]
+    if not paths:
+        raise FileNotFoundError(f"No CSV file or shard matches {csv_file}")
+
+    def thread_index(path):
+        m = re.search(r'_t(\d+)\.[^.]*$', path)
+        return (int(m.group(1)) if m else -1, path)
+    return sorted(paths, key=thread_index)
+
+
+def read_steps(csv_file, pdg_codes=None, max_workers=None):
+    """Read one MuonSteps CSV or all of its thread shards into one DataFrame.
+
+    Shards are parsed concurrently in worker processes. Geant4 numbers events
+    globally across worker threads, so each EventID must come from exactly one
+    shard; the merged rows are ordered by EventID, keeping the step order
+    within each event.
+
+    Raises:
+        ValueError: If an EventID appears in more than one shard, e.g. when
+            shards of different runs are mixed.
+    """
+    import pandas as pd
+
+    paths = expand_csv_shards(csv_file)
+    if len(paths) == 1:
+        return read_steps_csv(paths[0], pdg_codes)
+
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+
+    # no more processes than shards
+    max_workers = min(len(paths), max_workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        frames = list(pool.map(partial(read_steps_csv, pdg_codes=pdg_codes),
+                               paths))
+    frames = [(p, df) for p, df in zip(paths, frames) if len(df) > 0]
+    if not frames:
+        return pd.DataFrame(columns=csv_names)
+
+    shard_ids = [np.unique(df['EventID']) for _, df in frames]
+    ids, counts = np.unique(np.concatenate(shard_ids), return_counts=True)
+    if np.any(counts > 1):
+        event_id = ids[counts > 1][0]
+        owners = [p for (p, _), u in zip(frames, shard_ids) if event_id in u]
+        raise ValueError(f"EventID {event_id} appears in several shards {owners}; "
+                         "shards do not belong to one run.")
+    df = pd.concat([df for _, df in frames], ignore_index=True)
+    return df.sort_values('EventID', kind='stable', ignore_index=True)
+
+
+def tpc_directions(x, tol=1E-4):
+    """Return the drift direction (+1/-1) of the TPC containing each x.
+
+    Raises:
+        ValueError: If any x lies outside every TPC border.
+    """
+    x = np.asarray(x)
+    direction = np.zeros(len(x), dtype=np.int8)
+    for i, border in enumerate(tpc_borders):
+        # Check which segments are within this border range
+        mask = (x >= border[0]-tol) & (x <= border[1]+tol) # tolerance
+        direction[mask] = tpc_direction[i]
+    if np.any(direction == 0):
+        raise ValueError("Some segments are not within TPC borders. "
+                         "Check the x_start and x_end values.")
+    return direction
+
+
+def steps_to_segments(df):
+    """Map a filtered MuonSteps DataFrame onto a ``segment_dtype`` array."""
+    t0_start = df['t0_start(us)'].to_numpy(np.float64) \
+        + df['EventID'].to_numpy(np.float64) * 1.2e6
+    t0_end = df['t0_end(us)'].to_numpy(np.float64) \
+        + df['EventID'].to_numpy(np.float64) * 1.2e6
+    dx = df['StepLength(cm)'].to_numpy(np.float64)
+    dE = df['Edep(MeV)'].to_numpy(np.float64)
+
+    # Map to structured array; unset fields are preallocated zeros
+    data = np.zeros(len(df), dtype=segment_dtype)
+    data['event_id']     = df['EventID'].astype(np.uint32)
+    data['segment_id']   = df['StepID'].astype(np.uint32)
+    data['vertex_id']    = (df['EventID'] + 1000).astype(np.uint64)
+    data['traj_id']      = df['TrackID'].astype(np.uint32)
+    data['file_traj_id'] = df['TrackID'].astype(np.uint32)
+    data['pdg_id']       = df['PDG_ID'].astype(np.int32)
+    for axis in 'xyz':
+        start = df[f'{axis}_start(cm)'].to_numpy(np.float64)
+        end = df[f'{axis}_end(cm)'].to_numpy(np.float64)
+        data[f'{axis}_start'] = start
+        data[f'{axis}_end'] = end
+        data[axis] = (start + end) / 2.0
+    data['dx']           = dx
+    data['dE']           = dE
+    with np.errstate(divide='ignore', invalid='ignore'):
+        data['dEdx']     = dE / dx
+    data['t0_start']     = t0_start
+    data['t0_end']       = t0_end
+    data['t0']           = (t0_start + t0_end) / 2.0
+    return data
+
+
+def _derive(data, name):
+    """Recompute the derivable column ``name`` from the stored ones."""
+    if name == 'file_traj_id':
+        return data['traj_id']
+    if name == 't0':
+        return (data['t0_start'] + data['t0_end']) / 2.0
+    if name == 'dEdx':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (data['dE'].astype(np.float64) / data['dx']).astype(np.float32)
+    start = data[f'{name}_start'].astype(np.float64)
+    return ((start + data[f'{name}_end']) / 2.0).astype(np.float32)
+
+
+def _matches(stored, derived):
+    """True if ``derived`` reproduces ``stored`` within 2 ulp (exactly for integers)."""
+    if stored.dtype.kind != 'f':
+        return bool(np.array_equal(stored, derived))
+    with np.errstate(invalid='ignore'):
+        close = np.abs(stored - derived) <= 2 * np.spacing(np.abs(stored))
+    same = (stored == derived) | (np.isnan(stored) & np.isnan(derived))
+    return bool(np.all(close | same))
+
+
+def compact_layout(blocks):
+    """Decide which columns the compact profile can drop for ``blocks``.
+
+    A column of ``compact_constant_fields`` is dropped if it holds a single
+    value over all blocks; a column of ``compact_derived_fields`` is dropped
+    if recomputing it from the stored columns agrees within 2 float32 ulp,
+    the rounding of computing a midpoint or dE/dx before the float32 cast.
+
+    Args:
+        blocks (iterable[np.ndarray]): Arrays with segment_dtype fields.
+
+    Returns:
+        dict: ``{'constants': {name: value}, 'derived': [name, ...]}``.
+    """
+    constants = None
+    derived = list(compact_derived_fields)
+    for block in blocks:
+        if len(block) == 0:
+            continue
+        if constants is None:
+            constants = {name: block[name][0] for name in compact_constant_fields}
+        constants = {name: value for name, value in constants.items()
+                     if np.all(block[name] == value)}
+        derived = [name for name in derived if _matches(block[name], _derive(block, name))]
+    return {'constants': constants or {}, 'derived': derived}
+
+
+def compact_dtype(layout):
+    """Packed dtype of the columns the compact ``layout`` stores."""
+    dropped = set(layout['constants']) | set(layout['derived'])
+    return np.dtype([(name, segment_dtype[name]) for name in segment_dtype.names
+                     if name not in dropped])
+
+
+def to_compact(data, layout):
+    """Pack a segment_dtype array into the compact ``layout``.
+
+    Raises:
+        ValueError: If ``data`` does not fit ``layout``, e.g. a dropped
+            constant column holds another value.
+    """
+    check = compact_layout([data])
+    if len(data) and not (set(layout['constants']) <= set(check['constants'])
+            and all(check['constants'][k] == v for k, v in layout['constants'].items())
+            and set(layout['derived']) <= set(check['derived'])):
+        raise ValueError("Segments do not fit the compact layout; "
+                         "a column it drops would lose data.")
+    dtype = compact_dtype(layout)
+    out = np.empty(len(data), dtype=dtype)
+    for name in dtype.names:
+        out[name] = data[name]
+    return out
+
+
+def expand_compact(data, layout):
+    """Expand a compact array back to a full segment_dtype array."""
+    out = np.empty(len(data), dtype=segment_dtype)
+    for name in data.dtype.names:
+        out[name] = data[name]
+    for name, value in layout['constants'].items():
+        out[name] = value
+    for name in compact_derived_fields:
+        if name in layout['derived']:
+            out[name] = _derive(out, name)
+    return out
+
+
+def write_compact_layout(ds, layout):
+    """Record the compact ``layout`` in the attributes of dataset ``ds``."""
+    ds.attrs['profile'] = 'compact'
+    ds.attrs['constant_fields'] = list(layout['constants'])
+    ds.attrs['derived_fields'] = list(layout['derived'])
+    for name, value in layout['constants'].items():
+        ds.attrs[name] = np.asarray(value, dtype=segment_dtype[name])
+
+
+def read_compact_layout(path, dataset_name='segments'):
+    """Return the compact layout of a dataset, or None for the full profile."""
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        attrs = f[dataset_name].attrs
+        if attrs.get('profile') != 'compact':
+            return None
+        return {'constants': {str(name): attrs[name] for name in attrs['constant_fields']},
+                'derived': [str(name) for name in attrs['derived_fields']]}
+
+
+def _contiguous_offset(ds):
+    """Return the file offset of ``ds`` if it can be memory-mapped, else None.
+
+    Only contiguous, unfiltered, non-external datasets whose on-disk type is
+    byte-identical to ``ds.dtype`` qualify.
+    """
+    import h5py
+
+    if ds.chunks is not None or ds.external or ds.dtype.hasobject:
+        return None
+    if not ds.id.get_type().equal(h5py.h5t.py_create(ds.dtype)):
+        return None
+    return ds.id.get_offset()
+
+
+def open_memmap(path, dataset_name='segments'):
+    """Map a contiguous, uncompressed dataset read-only into memory.
+
+    The pages are shared through the page cache, so several processes reading
+    the same file do not each hold a private copy.
+
+    Returns:
+        np.memmap or None: None if the dataset is chunked, compressed, empty
+        or otherwise not stored as one raw block in the file.
+    """
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        ds = f[dataset_name]
+        offset = _contiguous_offset(ds)
+        dtype, shape = ds.dtype, ds.shape
+    if offset is None:
+        return None
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def _blocks(n_rows, step, ranges=None):
+    """Split ``ranges`` (default: all rows) into [start, stop) blocks of at most ``step`` rows."""
+    for start, stop in ranges if ranges is not None else [(0, n_rows)]:
+        for i in range(int(start), int(stop), step):
+            yield i, min(i + step, int(stop))
+
+
+def iter_chunks(path, dataset_name='segments', chunk_rows=None, ranges=None):
+    """Yield consecutive row blocks of a dataset without loading it whole.
+
+    Contiguous datasets are served as read-only slices of :func:`open_memmap`;
+    chunked or compressed ones are read hyperslab by hyperslab, in blocks
+    aligned to the dataset chunk size. Datasets in the compact profile are
+    expanded to segment_dtype block by block.
+
+    Args:
+        ranges (iterable[tuple[int, int]], optional): Only read these
+            [start, stop) row ranges, in the given order.
+    """
+    layout = read_compact_layout(path, dataset_name)
+    for block in _iter_raw_chunks(path, dataset_name, chunk_rows, ranges):
+        yield block if layout is None else expand_compact(block, layout)
+
+
+def _iter_raw_chunks(path, dataset_name, chunk_rows, ranges):
+    """Row blocks of a dataset as stored, see :func:`iter_chunks`."""
+    import h5py
+
+    mm = open_memmap(path, dataset_name)
+    if mm is not None:
+        for i, j in _blocks(len(mm), chunk_rows or 1 << 16, ranges):
+            yield mm[i:j]
+        return
+    with h5py.File(path, 'r') as f:
+        ds = f[dataset_name]
+        step = chunk_rows
+        if step is None:
+            step = 1 << 16
+            if ds.chunks is not None:
+                step = ds.chunks[0] * max(1, step // ds.chunks[0])
+        for i, j in _blocks(ds.shape[0], step, ranges):
+            yield ds[i:j]
+
+
+def load_dataset(path, dataset_name, mmap=True):
+    """
+    Load structured array from an HDF5 file.
+
+    With ``mmap`` a contiguous dataset is returned as a read-only memmap
+    instead of an in-memory copy.
+    """
+    import h5py
+
+    data = open_memmap(path, dataset_name) if mmap else None
+    if data is None:
+        with h5py.File(path, 'r') as f:
+            data = f[dataset_name][:]
+    return data
+
+
+def build_event_index(event_id, offset=0):
+    """Run-length encode an event_id column into an ``event_index_dtype`` array.
+
+    Each run of consecutive equal event_ids becomes one entry, so an event
+    split across several places of an unsorted file gets several entries.
+    Row numbers start at ``offset``, the position of the block in its file.
+    """
+    event_id = np.asarray(event_id)
+    starts = np.flatnonzero(np.diff(event_id)) + 1
+    starts = np.concatenate(([0], starts)) if len(event_id) else starts
+    index = np.zeros(len(starts), dtype=event_index_dtype)
+    index['event_id'] = event_id[starts]
+    index['start'] = starts + offset
+    index['stop'] = np.append(starts[1:], len(event_id)) + offset
+    return index
+
+
+def join_event_index(blocks):
+    """Concatenate the indices of consecutive blocks into one event index.
+
+    Lets a writer index while streaming: index each block with its row
+    offset, then join; entries of an event that spans two blocks are merged.
+    """
+    index = np.concatenate(list(blocks)) if blocks else np.zeros(0, dtype=event_index_dtype)
+    if len(index) == 0:
+        return index
+    first = np.ones(len(index), dtype=bool)
+    first[1:] = (index['event_id'][1:] != index['event_id'][:-1]) \
+        | (index['start'][1:] != index['stop'][:-1])
+    last = np.append(np.flatnonzero(first)[1:] - 1, len(index) - 1)
+    index['stop'][first] = index['stop'][last]
+    return index[first]
+
+
+def _reduce_events(event_id, columns):
+    """Sort by event_id once and reduce ``columns`` per event.
+
+    Args:
+        event_id (np.ndarray): Event id of every row.
+        columns (dict): event_summary_dtype field -> (ufunc, per-row values).
+    """
+    out = np.zeros(0, dtype=event_summary_dtype)
+    if len(event_id) == 0:
+        return out
+    order = np.argsort(event_id, kind='stable')
+    event_id = event_id[order]
+    starts = np.flatnonzero(np.r_[True, event_id[1:] != event_id[:-1]])
+    out = np.zeros(len(starts), dtype=event_summary_dtype)
+    out['event_id'] = event_id[starts]
+    for name, (ufunc, values) in columns.items():
+        out[name] = ufunc.reduceat(values[order], starts)
+    return out
+
+
+def event_summary(data):
+    """Per-event totals of a segment_dtype array, in event_id order.
+
+    Counts and sums of dE and dx per event, the bounding box of the segment
+    end points, the t0 range and the numbers of muon and electron steps, in
+    one sort plus ``reduceat`` reductions.
+    """
+    pdg = np.abs(data['pdg_id'])
+    columns = {
+        'n_segments': (np.add, np.ones(len(data), dtype=np.uint64)),
+        'n_muon': (np.add, (pdg == 13).astype(np.uint64)),
+        'n_electron': (np.add, (pdg == 11).astype(np.uint64)),
+        'dE': (np.add, data['dE'].astype(np.float64)),
+        'dx': (np.add, data['dx'].astype(np.float64)),
+        't0_min': (np.minimum, data['t0_start']),
+        't0_max': (np.maximum, data['t0_end']),
+    }
+    for axis in 'xyz':
+        lo = np.minimum(data[f'{axis}_start'], data[f'{axis}_end'])
+        hi = np.maximum(data[f'{axis}_start'], data[f'{axis}_end'])
+        columns[f'{axis}_min'] = (np.minimum, lo)
+        columns[f'{axis}_max'] = (np.maximum, hi)
+    return _reduce_events(np.asarray(data['event_id']), columns)
+
+
+def combine_summaries(summaries):
+    """Combine event summaries of consecutive blocks into one table.
+
+    Lets a writer summarize while streaming: summarize each block, then
+    combine; events split across blocks are merged.
+    """
+    table = np.concatenate(list(summaries)) if summaries else \
+        np.zeros(0, dtype=event_summary_dtype)
+    columns = {}
+    for name in event_summary_dtype.names[1:]:
+        ufunc = np.minimum if name.endswith('_min') else \
+            np.maximum if name.endswith('_max') else np.add
+        columns[name] = (ufunc, table[name])
+    return _reduce_events(table['event_id'], columns)
+
+
+def load_event_index(path, dataset_name='event_index'):
+    """Return the event index of ``path``, or None if it has none."""
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        if dataset_name not in f:
+            return None
+        return f[dataset_name][:]
+
+
+def load_source_event_ids(path):
+    """Return the picked track ids (``event_id*10 + io_group``) of a flow file."""
+    import h5py
+
+    with h5py.File(path, 'r') as fin:
+        event_ids = fin['/picked/event_id/data'][:]
+        io_group = fin['/picked/io_group/data'][:]
+    return event_ids*10 + io_group
+
+
+def load_segments(path, dataset_name='segments', mmap=True):
+    """Load the segments dataset of ``path``.
+
+    With ``mmap`` a contiguous dataset is returned as a read-only memmap.
+    Datasets in the compact profile are expanded to segment_dtype.
+
+    Raises:
+        KeyError: If the file has no ``dataset_name`` dataset.
+    """
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        if dataset_name not in f:
+            raise KeyError(f"File {path} does not contain '{dataset_name}' dataset.")
+    data = load_dataset(path, dataset_name, mmap=mmap)
+    layout = read_compact_layout(path, dataset_name)
+    return data if layout is None else expand_compact(data, layout)
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """Yield a temporary path next to ``path`` that replaces ``path`` on success.
+
+    The file is synced and renamed over ``path`` only when the block finishes,
+    so ``path`` is never seen half written; the directory is synced too, so
+    the rename survives a node crash. On an error the temporary file is
+    removed; a killed process may leave a ``<path>.tmp<pid>`` file behind.
+    """
+    tmp = f'{path}.tmp{os.getpid()}'
+    try:
+        yield tmp
+        with open(tmp, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def write_segments(path, data, dataset_name='segments', compact=False, summary=False):
+    """Write ``data`` as the segments dataset of a new HDF5 file.
+
+    With ``compact`` the dataset is written in the compact profile, see
+    :func:`compact_layout`. With ``summary`` an 'event_summary' dataset is
+    written too, see :func:`event_summary`. An 'event_index' dataset lets
+    event selections read only the rows of their events. The file is written
+    atomically, see :func:`atomic_output`.
+    """
+    import h5py
+
+    with atomic_output(path) as tmp, h5py.File(tmp, 'w') as f:
+        f.create_dataset('event_index', data=build_event_index(data['event_id']))
+        if summary:
+            f.create_dataset('event_summary', data=event_summary(data))
+        if not compact:
+            f.create_dataset(dataset_name, data=data)
+            return
+        layout = compact_layout([data])
+        ds = f.create_dataset(dataset_name, data=to_compact(data, layout))
+        write_compact_layout(ds, layout)
+
+
+def input_fingerprint(csv_file, **options):
+    """Fingerprint of a conversion: its CSV shards and the options it ran with.
+
+    Shards are identified by absolute path, size and modification time.
+    """
+    inputs = []
+    for path in expand_csv_shards(csv_file):
+        st = os.stat(path)
+        inputs.append([os.path.abspath(path), st.st_size, st.st_mtime_ns])
+    return {'inputs': inputs, 'options': options}
+
+
+class ConversionJournal:
+    """Append-only record of finished runs of a batch conversion.
+
+    Each line is a JSON object with the run name, its output and the
+    :func:`input_fingerprint` it was converted from. Lines are synced as they
+    are written; a line cut short by a crash is ignored on reading.
+    """
+
+    def __init__(self, path, resume=True):
+        self.path = path
+        self.entries = {}
+        if not resume:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[entry['run']] = entry
+        except FileNotFoundError:
+            pass
+
+    def is_current(self, run, fingerprint, output):
+        """True if ``run`` finished into ``output`` from the same inputs and options."""
+        entry = self.entries.get(run)
+        output = os.path.abspath(output)
+        return entry is not None and entry['output'] == output \
+            and entry['fingerprint'] == fingerprint and os.path.exists(output)
+
+    def record(self, run, fingerprint, output):
+        entry = {'run': run, 'output': os.path.abspath(output), 'fingerprint': fingerprint}
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[run] = entry
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import numpy as np
+
+from segments import iter_chunks, load_event_index, segment_dtype, tpc_borders, \
+    write_segments
+
+
+def segment_mask(data, pdg=None, event_range=None, event_ids=None, box=None,
+                 time_window=None):
+    """Return a boolean mask of the rows of ``data`` passing every predicate.
+
+    Args:
+        data (np.ndarray): Array with segment_dtype fields.
+        pdg (iterable[int], optional): Accepted pdg_id values.
+        event_range (tuple[int, int], optional): Accepted [first, last) event_id range.
+        event_ids (iterable[int], optional): Accepted event_id values.
+        box (sequence[float], optional): xmin, xmax, ymin, ymax, zmin, zmax, in the
+            order of tpc_borders. Both the start and the end point must lie inside.
+        time_window (tuple[float, float], optional): [t0_min, t0_max) window in us
+            that the segment's [t0_start, t0_end] must overlap.
+
+    Returns:
+        np.ndarray: Boolean mask of valid rows.
+    """
+    mask = np.ones(len(data), dtype=bool)
+    if pdg is not None:
+        mask &= np.isin(data['pdg_id'], list(pdg))
+    if event_range is not None:
+        mask &= (data['event_id'] >= event_range[0]) & (data['event_id'] < event_range[1])
+    if event_ids is not None:
+        mask &= np.isin(data['event_id'], list(event_ids))
+    if box is not None:
+        for i, axis in enumerate('xyz'):
+            lo, hi = box[2*i], box[2*i+1]
+            for point in ('start', 'end'):
+                v = data[f'{axis}_{point}']
+                mask &= (v >= lo) & (v <= hi)
+    if time_window is not None:
+        mask &= (data['t0_end'] >= time_window[0]) & (data['t0_start'] < time_window[1])
+    return mask
+
+
+def summary_event_ids(summary, pdg=None, box=None, time_window=None):
+    """Return the event_ids of ``summary`` that may hold segments passing the predicates.
+
+    Uses the per-event muon/electron counts, bounding box and t0 range of an
+    event_summary table; events ruled out by them hold no passing segment.
+
+    Args:
+        summary (np.ndarray): Array with event_summary_dtype fields.
+    """
+    mask = np.ones(len(summary), dtype=bool)
+    if pdg is not None:
+        pdg = set(abs(int(p)) for p in pdg)
+        n_other = summary['n_segments'] - summary['n_muon'] - summary['n_electron']
+        has = np.zeros(len(summary), dtype=bool)
+        if 13 in pdg:
+            has |= summary['n_muon'] > 0
+        if 11 in pdg:
+            has |= summary['n_electron'] > 0
+        if pdg - {11, 13}:
+            has |= n_other > 0
+        mask &= has
+    if box is not None:
+        for i, axis in enumerate('xyz'):
+            mask &= (summary[f'{axis}_max'] >= box[2*i]) & (summary[f'{axis}_min'] <= box[2*i+1])
+    if time_window is not None:
+        mask &= (summary['t0_max'] >= time_window[0]) & (summary['t0_min'] < time_window[1])
+    return summary['event_id'][mask]
+
+
+def event_ranges(index, event_range=None, event_ids=None, candidates=None):
+    """Return the merged [start, stop) row ranges of the events passing the event predicates.
+
+    Args:
+        index (np.ndarray): Array with event_index_dtype fields.
+        candidates (np.ndarray, optional): Only these event_ids may pass, see
+            :func:`summary_event_ids`.
+
+    Returns:
+        list[tuple[int, int]]: Row ranges in file order; adjacent ranges are merged.
+    """
+    mask = segment_mask(index, event_range=event_range, event_ids=event_ids)
+    if candidates is not None:
+        mask &= np.isin(index['event_id'], candidates)
+    selected = np.sort(index[mask], order='start')
+    if len(selected) == 0:
+        return []
+    starts, stops = selected['start'], selected['stop']
+    first = np.ones(len(selected), dtype=bool)
+    first[1:] = starts[1:] != stops[:-1]
+    last = np.append(np.flatnonzero(first)[1:] - 1, len(selected) - 1)
+    return list(zip(starts[first].tolist(), stops[last].tolist()))
+
+
+def select_segments(path, dataset_name='segments', chunk_rows=None, **predicates):
+    """Stream ``path`` and return only the segments passing ``predicates``.
+
+    Predicates are those of :func:`segment_mask` and are evaluated block by
+    block, so memory follows the selection rather than the file. When the file
+    has an ``event_index`` (written by the converters, merge.py and
+    sort_segments.py), only the row ranges of events that can pass are read:
+    event predicates select events directly, and with an ``event_summary``
+    table (written with --summary) the pdg, box and time predicates rule out
+    events by their muon/electron counts, bounding box and t0 range. Without
+    these tables the whole file is read.
+    """
+    import h5py
+
+    ranges = None
+    event_predicates = predicates.get('event_range') is not None \
+        or predicates.get('event_ids') is not None
+    other_predicates = {name: predicates.get(name) for name in ('pdg', 'box', 'time_window')
+                        if predicates.get(name) is not None}
+    index = load_event_index(path) if event_predicates or other_predicates else None
+    if index is not None:
+        candidates = None
+        if other_predicates:
+            with h5py.File(path, 'r') as f:
+                if 'event_summary' in f:
+                    candidates = summary_event_ids(f['event_summary'][:], **other_predicates)
+        if event_predicates or candidates is not None:
+            ranges = event_ranges(index, predicates.get('event_range'),
+                                  predicates.get('event_ids'), candidates)
+    parts = [chunk[segment_mask(chunk, **predicates)]
+             for chunk in iter_chunks(path, dataset_name, chunk_rows, ranges)]
+    if not parts:
+        return np.zeros(0, dtype=segment_dtype)
+    return np.concatenate(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy the segments matching simple predicates to a new HDF5 file.")
+    parser.add_argument('input_file', help='Path to the input HDF5 file.')
+    parser.add_argument('output_file', help='Path to the output HDF5 file.')
+    parser.add_argument('--pdg', type=int, nargs='+', help='Accepted pdg_id values, e.g. --pdg 13 -13.')
+    parser.add_argument('--events', type=int, nargs=2, metavar=('FIRST', 'LAST'),
+                        help='Accepted event_id range [FIRST, LAST).')
+    parser.add_argument('--event-ids', type=int, nargs='+', help='Accepted event_id values.')
+    parser.add_argument('--box', type=float, nargs=6,
+                        metavar=('XMIN', 'XMAX', 'YMIN', 'YMAX', 'ZMIN', 'ZMAX'),
+                        help='Axis-aligned box in cm containing both segment end points.')
+    parser.add_argument('--tpc', type=int, choices=range(len(tpc_borders)),
+                        help='Use the borders of this TPC as --box.')
+    parser.add_argument('--time', type=float, nargs=2, metavar=('T0_MIN', 'T0_MAX'),
+                        help='Time window [T0_MIN, T0_MAX) in us the segment must overlap.')
+    args = parser.parse_args()
+
+    box = tpc_borders[args.tpc] if args.tpc is not None else args.box
+    data = select_segments(args.input_file, pdg=args.pdg, event_range=args.events,
+                           event_ids=args.event_ids, box=box, time_window=args.time)
+    print(f"Selected {len(data)} segments from {args.input_file}")
+    write_segments(args.output_file, data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+
+import numpy as np
+
+from segments import build_event_index, compact_dtype, iter_chunks, join_event_index, \
+    read_compact_layout, segment_dtype, to_compact, write_compact_layout
+
+
+def _lexsort(data, key, pos):
+    """Indices sorting ``data`` by the fields of ``key``, ties broken by ``pos``."""
+    return np.lexsort([pos] + [data[name] for name in reversed(key)])
+
+
+def _less_equal(column, b):
+    """Elementwise ``column < b`` and ``column == b`` in np.lexsort order, NaN last."""
+    if column.dtype.kind != 'f':
+        return column < b, column == b
+    nan = np.isnan(column)
+    if np.isnan(b):
+        return ~nan, nan
+    return ~nan & (column < b), column == b
+
+
+def _order_key(bound):
+    """Sort key of a (key, pos) tuple that orders NaN last, as np.lexsort does."""
+    return tuple((1, 0.) if v != v else (0, v) for v in bound)
+
+
+def _count_le(data, key, pos, bound):
+    """Number of leading rows of a sorted block whose (key, pos) is <= ``bound``."""
+    le = np.zeros(len(data), dtype=bool)
+    eq = np.ones(len(data), dtype=bool)
+    for column, b in zip([data[name] for name in key] + [pos], bound):
+        lt, same = _less_equal(column, b)
+        le |= eq & lt
+        eq &= same
+    return int(np.count_nonzero(le | eq))
+
+
+def _last_key(data, key, pos):
+    return tuple(data[name][-1].item() for name in key) + (pos[-1].item(),)
+
+
+class _Run:
+    """Buffered reader of one sorted run stored in the scratch file."""
+
+    def __init__(self, group, buffer_rows):
+        self.data, self.pos = group['data'], group['pos']
+        self.buffer_rows = buffer_rows
+        self.next = 0
+        self.buf = self.data[0:0]
+        self.buf_pos = self.pos[0:0]
+
+    def fill(self):
+        if len(self.buf) == 0 and self.next < len(self.data):
+            stop = min(self.next + self.buffer_rows, len(self.data))
+            self.buf, self.buf_pos = self.data[self.next:stop], self.pos[self.next:stop]
+            self.next = stop
+
+    @property
+    def exhausted(self):
+        return self.next >= len(self.data)
+
+    def take(self, n):
+        rows, pos = self.buf[:n], self.buf_pos[:n]
+        self.buf, self.buf_pos = self.buf[n:], self.buf_pos[n:]
+        return rows, pos
+
+
+def sort_segments(input_file, output_file, key=('event_id', 't0_start'), memory_mb=512,
+                  dataset_name='segments'):
+    """Sort a segments dataset by ``key`` without holding it in memory.
+
+    Blocks that fit into ``memory_mb`` are sorted into runs in a scratch file
+    next to the output, then k-way merged into a new chunked dataset. Rows with
+    equal keys keep their input order; NaN keys sort last, as in np.lexsort. The output also gets an 'event_index'
+    dataset with the row range of every event. A compact input is written back
+    in its compact layout.
+
+    Args:
+        input_file (str): Path to the input HDF5 file.
+        output_file (str): Path to the output HDF5 file.
+        key (sequence[str]): segment_dtype fields to sort by, most significant first.
+        memory_mb (float): Memory budget for rows held at once.
+        dataset_name (str): Name of the segments dataset.
+    """
+    import h5py
+
+    key = list(key)
+    for name in key:
+        if name not in segment_dtype.names:
+            raise ValueError(f"Unknown sort key field '{name}'.")
+    layout = read_compact_layout(input_file, dataset_name)
+    with h5py.File(input_file, 'r') as f:
+        n_rows = f[dataset_name].shape[0]
+    # a sort holds the block, its sorted copy and the key columns
+    run_rows = max(1, int(memory_mb * 2**20) // (3 * segment_dtype.itemsize))
+
+    scratch = output_file + '.runs.tmp'
+    with h5py.File(output_file, 'w') as h5out:
+        dtype = segment_dtype if layout is None else compact_dtype(layout)
+        out = h5out.create_dataset(dataset_name, shape=(n_rows,), dtype=dtype,
+                                   maxshape=(None,), chunks=(1 << 14,))
+        if layout is not None:
+            write_compact_layout(out, layout)
+        written = [0]
+        index = []
+
+        def emit(rows):
+            start = written[0]
+            out[start:start+len(rows)] = rows if layout is None else to_compact(rows, layout)
+            index.append(build_event_index(rows['event_id'], start))
+            written[0] += len(rows)
+
+        if n_rows <= run_rows:
+            data = np.concatenate(list(iter_chunks(input_file, dataset_name))) if n_rows \
+                else np.zeros(0, dtype=segment_dtype)
+            emit(data[_lexsort(data, key, np.arange(n_rows))])
+        else:
+            try:
+                with h5py.File(scratch, 'w') as tmp:
+                    offset = 0
+                    for i, data in enumerate(iter_chunks(input_file, dataset_name, run_rows)):
+                        pos = np.arange(offset, offset + len(data), dtype=np.uint64)
+                        order = _lexsort(data, key, pos)
+                        tmp.create_dataset(f'run{i}/data', data=data[order])
+                        tmp.create_dataset(f'run{i}/pos', data=pos[order])
+                        offset += len(data)
+                    runs = [_Run(tmp[name], max(1, run_rows // (len(tmp) + 1)))
+                            for name in tmp]
+                    while True:
+                        for run in runs:
+                            run.fill()
+                        active = [run for run in runs if len(run.buf)]
+                        if not active:
+                            break
+                        # rows up to the smallest buffered maximum of the runs
+                        # with more rows on disk cannot be preceded by unread rows
+                        pending = [_last_key(run.buf, key, run.buf_pos)
+                                   for run in active if not run.exhausted]
+                        bound = min(pending, key=_order_key) if pending else None
+                        parts, positions = [], []
+                        for run in active:
+                            n = len(run.buf) if bound is None else \
+                                _count_le(run.buf, key, run.buf_pos, bound)
+                            rows, pos = run.take(n)
+                            parts.append(rows)
+                            positions.append(pos)
+                        rows, pos = np.concatenate(parts), np.concatenate(positions)
+                        if len(rows) == 0:
+                            raise RuntimeError("Merge of sorted runs made no progress.")
+                        emit(rows[_lexsort(rows, key, pos)])
+            finally:
+                if os.path.exists(scratch):
+                    os.remove(scratch)
+
+        index = join_event_index(index)
+        h5out.create_dataset('event_index', data=index)
+        out.attrs['sort_key'] = key
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sort a segments HDF5 file out of core and write its per-event index.")
+    parser.add_argument('input_file', help='Path to the input HDF5 file.')
+    parser.add_argument('output_file', help='Path to the output HDF5 file.')
+    parser.add_argument('--key', nargs='+', default=['event_id', 't0_start'],
+                        help='segment_dtype fields to sort by, most significant first. Default: event_id t0_start')
+    parser.add_argument('--memory_mb', type=float, default=512, help='Memory budget in MB. Default: 512')
+    args = parser.parse_args()
+    sort_segments(args.input_file, args.output_file, args.key, args.memory_mb)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+import numpy as np
+
+from segments import combine_summaries, event_summary, event_summary_dtype, iter_chunks
+
+
+def load_event_summary(path):
+    """Return the event summary of ``path``.
+
+    Reads the 'event_summary' dataset if the writer emitted one, otherwise
+    computes it while streaming the segments.
+    """
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        if 'event_summary' in f:
+            return f['event_summary'][:]
+    return combine_summaries([event_summary(data) for data in iter_chunks(path)])
+
+
+def print_summary(table, path):
+    print(f"{path}: {len(table)} events, {int(table['n_segments'].sum())} segments, "
+          f"dE {table['dE'].sum():.6g} MeV")
+    print(' '.join(f'{name:>12}' for name in event_summary_dtype.names))
+    for row in table:
+        print(' '.join(f'{value:>12.6g}' if isinstance(value, float) else f'{value:>12}'
+                       for value in row.tolist()))
+
+
+def compare_summaries(a, b, rtol=1E-6):
+    """Compare two event summaries.
+
+    Returns:
+        list[str]: One line per difference; empty if the summaries agree.
+    """
+    lines = []
+    only_a = np.setdiff1d(a['event_id'], b['event_id'])
+    only_b = np.setdiff1d(b['event_id'], a['event_id'])
+    if len(only_a):
+        lines.append(f"events only in first file: {only_a.tolist()}")
+    if len(only_b):
+        lines.append(f"events only in second file: {only_b.tolist()}")
+    common, ia, ib = np.intersect1d(a['event_id'], b['event_id'], return_indices=True)
+    for name in event_summary_dtype.names[1:]:
+        va, vb = a[name][ia], b[name][ib]
+        if va.dtype.kind == 'f':
+            diff = ~np.isclose(va, vb, rtol=rtol, atol=0)
+        else:
+            diff = va != vb
+        for eid, x, y in zip(common[diff].tolist(), va[diff].tolist(), vb[diff].tolist()):
+            lines.append(f"event {eid}: {name} {x} != {y}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print or compare per-event summaries of segments files.")
+    parser.add_argument('files', nargs='+', help='One file to print, or two files to compare.')
+    parser.add_argument('--compare', action='store_true', help='Compare the first file with each of the others.')
+    parser.add_argument('--rtol', type=float, default=1E-6, help='Relative tolerance for floating point fields. Default: 1e-6')
+    args = parser.parse_args()
+
+    if not args.compare:
+        for path in args.files:
+            print_summary(load_event_summary(path), path)
+        return
+    if len(args.files) < 2:
+        parser.error("--compare needs at least two files")
+    ref = load_event_summary(args.files[0])
+    status = 0
+    for path in args.files[1:]:
+        lines = compare_summaries(ref, load_event_summary(path), args.rtol)
+        print(f"{args.files[0]} vs {path}: " + ("same" if not lines else f"{len(lines)} differences"))
+        for line in lines:
+            print("  " + line)
+        status = status or int(bool(lines))
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
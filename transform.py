@@ -1,13 +1,6 @@
-import h5py
 import numpy as np
 
-def load_dataset(path, dataset_name):
-    """
-    Load structured array from an HDF5 file.
-    """
-    with h5py.File(path, 'r') as f:
-        data = f[dataset_name][:]
-    return data
+from segments import load_dataset, load_segments, write_segments
 
 def group_by_event(data):
     """
@@ -136,7 +129,7 @@ if __name__ == '__main__':
 
     # Load data
     data1 = load_dataset(path1, name1)
-    data2 = load_dataset(path2, name2)
+    data2 = load_segments(path2, name2)
 
     # Group by event_id into lists (order by sorted event_id)
     groups1 = group_by_event(data1)
@@ -151,10 +144,10 @@ if __name__ == '__main__':
         transformed_groups2.append(aligned)
         # print(np.max(aligned['z_start']), np.max(aligned['z_end']))
 
-    # with h5py.File("pgun_mu_only_transformed.hdf5", "w") as f:
-    #     f.create_dataset('segments', data=np.concatenate(transformed_groups2))
-    with h5py.File("pgun_mu_5GeV_transformed.hdf5", "w") as f:
-        f.create_dataset('segments', data=np.concatenate(transformed_groups2))
+    # write_segments("pgun_mu_only_transformed.hdf5",
+    #                np.concatenate(transformed_groups2))
+    write_segments("pgun_mu_5GeV_transformed.hdf5",
+                   np.concatenate(transformed_groups2))
 
     # transformed_groups2 now contains arrays of aligned start points for each paired event
     # Further processing or saving can follow here.
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+default_steps = [
+    f'{shlex.quote(sys.executable)} prepare.py {{input}}',
+    'build/MuonLArSim {name}/pgun_mu_3p00GeV.mac',
+    f'{shlex.quote(sys.executable)} convert_pgun.py --hdf5_source {{input}} '
+    '{name}/mu_3p00GeV_nt_MuonSteps.csv {name}/pgun_mu_3GeV_2mm.hdf5',
+]
+
+final_key = '_final'
+
+
+def read_run_list(run_list):
+    """Return (name, path) of every input in ``run_list``.
+
+    ``name`` is the basename without extension, the output directory used by
+    prepare.py, and names the item in the queue.
+
+    Raises:
+        ValueError: If two inputs share a name.
+    """
+    items = {}
+    with open(run_list) as f:
+        for line in f:
+            path = line.strip()
+            if not path or path.startswith('#'):
+                continue
+            name = os.path.splitext(os.path.basename(path))[0]
+            if name in items and items[name] != path:
+                raise ValueError(f"Inputs {items[name]} and {path} share the name {name}.")
+            items[name] = path
+    return list(items.items())
+
+
+class WorkQueue:
+    """Claim, done and failed markers for the items of one run list.
+
+    All state lives in ``queue_dir``, which must be on a file system shared
+    by every worker. A claim is a file created with O_CREAT | O_EXCL, so only
+    one worker gets it; its owner keeps touching it while it works. A claim
+    not touched for ``timeout`` seconds belongs to a dead worker and is
+    broken by renaming it away, which again only one worker can do. Times
+    are compared with file times on the shared file system, never with the
+    local clock, so clock skew between nodes does not matter.
+    """
+
+    def __init__(self, queue_dir, timeout=600.):
+        self.dir = queue_dir
+        self.timeout = timeout
+        self.worker = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        for sub in ('claims', 'done', 'failed', 'logs'):
+            os.makedirs(os.path.join(queue_dir, sub), exist_ok=True)
+
+    def path(self, kind, name):
+        return os.path.join(self.dir, kind, name)
+
+    def now(self):
+        """Current time of the shared file system."""
+        probe = os.path.join(self.dir, f'.clock.{self.worker}')
+        with open(probe, 'w'):
+            pass
+        try:
+            return os.stat(probe).st_mtime
+        finally:
+            os.remove(probe)
+
+    def is_done(self, name):
+        return os.path.exists(self.path('done', name))
+
+    def is_failed(self, name):
+        return os.path.exists(self.path('failed', name))
+
+    def claim(self, name):
+        """Try to claim ``name``; returns True if this worker now owns it."""
+        path = self.path('claims', name)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._break_stale(path):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.worker)
+            return True
+        return False
+
+    def _owner(self, path):
+        try:
+            with open(path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _break_stale(self, path):
+        """Remove the claim at ``path`` if its owner stopped touching it."""
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return True
+        if self.now() - mtime < self.timeout:
+            return False
+        owner = self._owner(path)
+        moved = f'{path}.stale.{self.worker}'
+        try:
+            os.rename(path, moved)
+        except FileNotFoundError:
+            return True  # another worker broke it first
+        if self._owner(moved) != owner:
+            # the claim was broken and retaken in between; give it back
+            try:
+                os.link(moved, path)
+            except FileExistsError:
+                pass
+            os.remove(moved)
+            return False
+        os.remove(moved)
+        print(f"Broke stale claim {os.path.basename(path)} of {owner}")
+        return True
+
+    def owns(self, name):
+        return self._owner(self.path('claims', name)) == self.worker
+
+    def touch(self, name):
+        if self.owns(name):
+            os.utime(self.path('claims', name))
+
+    def release(self, name):
+        if self.owns(name):
+            os.remove(self.path('claims', name))
+
+    def record(self, kind, name, message):
+        """Atomically write the ``kind`` ('done' or 'failed') marker of ``name``."""
+        path = self.path(kind, name)
+        tmp = f'{path}.tmp.{self.worker}'
+        with open(tmp, 'w') as f:
+            f.write(f'{self.worker} {message}\n')
+        os.replace(tmp, path)
+
+    def retry_failed(self):
+        for name in os.listdir(os.path.join(self.dir, 'failed')):
+            os.remove(self.path('failed', name))
+
+
+def expand_step(step, fields):
+    """Shell command of ``step`` with only the ``{field}`` placeholders of ``fields`` replaced.
+
+    Values are shell quoted; any other braces, globs and shell syntax are left
+    to ``sh``.
+    """
+    for key, value in fields.items():
+        step = step.replace('{' + key + '}', shlex.quote(value))
+    return step
+
+
+def run_steps(queue, name, steps, fields):
+    """Run ``steps`` through ``sh -c`` for one claimed item, touching its claim meanwhile.
+
+    Returns:
+        str or None: Description of the failed step, None on success.
+    """
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(queue.timeout / 4):
+            queue.touch(name)
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    try:
+        with open(queue.path('logs', name), 'a') as log:
+            for step in steps:
+                cmd = expand_step(step, fields)
+                log.write(f'# {queue.worker}: {cmd}\n')
+                log.flush()
+                try:
+                    code = subprocess.call(['sh', '-c', cmd], stdout=log, stderr=subprocess.STDOUT)
+                except OSError as e:
+                    return f'{cmd}: {e}'
+                if code != 0:
+                    return f'{cmd}: exit status {code}'
+        return None
+    finally:
+        stop.set()
+        thread.join()
+
+
+def work(run_list, queue_dir, steps=None, final=None, timeout=600., poll=10.):
+    """Process the items of ``run_list`` until none is left to claim.
+
+    Any number of workers, on any number of nodes, may run this on the same
+    ``queue_dir``. Each item is processed by one worker at a time; a worker
+    that dies leaves its claim to be taken over after ``timeout`` seconds.
+    Once every item is done, one worker runs the ``final`` step (e.g. a
+    ``merge.py --append``), and runs it again when items finish later.
+
+    Args:
+        run_list (str): File with one input path per line.
+        queue_dir (str): Shared directory holding the queue state.
+        steps (list[str]): Commands run in order for each item. ``{input}`` is
+            replaced by the input path and ``{name}`` by its name.
+        final (str): Command run once all items are done.
+        timeout (float): Seconds after which an untouched claim is stale.
+        poll (float): Seconds to wait when all remaining items are claimed.
+
+    Returns:
+        int: Number of failed items, or 1 if only the final step failed.
+    """
+    queue = WorkQueue(queue_dir, timeout)
+    items = read_run_list(run_list)
+    steps = default_steps if steps is None else steps
+    while True:
+        pending = [(name, path) for name, path in items
+                   if not queue.is_done(name) and not queue.is_failed(name)]
+        if not pending:
+            break
+        claimed = False
+        for name, path in pending:
+            if not queue.claim(name):
+                continue
+            claimed = True
+            # it may have finished between the listing and the claim
+            if queue.is_done(name) or queue.is_failed(name):
+                queue.release(name)
+                continue
+            print(f"{queue.worker}: processing {path}")
+            start = time.time()
+            try:
+                error = run_steps(queue, name, steps, {'input': path, 'name': name})
+                if error is None:
+                    queue.record('done', name, f'{time.time() - start:.1f}s')
+                else:
+                    print(f"{queue.worker}: {name} failed: {error}")
+                    queue.record('failed', name, error)
+            finally:
+                queue.release(name)
+        if not claimed:
+            time.sleep(poll)
+
+    failed = [name for name, _ in items if queue.is_failed(name)]
+    if failed:
+        print(f"{len(failed)} failed items, see {os.path.join(queue_dir, 'failed')}")
+    elif final is not None:
+        if run_final(queue, [name for name, _ in items], final) is not None:
+            return 1
+    return len(failed)
+
+
+def run_final(queue, names, final):
+    """Run ``final`` unless it already ran after the last item finished.
+
+    Returns:
+        str or None: Description of the failure if this worker ran it and it failed.
+    """
+    latest = max((os.stat(queue.path('done', name)).st_mtime for name in names), default=0.)
+    marker = queue.path('done', final_key)
+
+    def up_to_date():
+        return os.path.exists(marker) and os.stat(marker).st_mtime >= latest
+
+    if up_to_date() or not queue.claim(final_key):
+        return None
+    # another worker may have run it between the check and the claim
+    if up_to_date():
+        queue.release(final_key)
+        return None
+    try:
+        os.remove(marker)
+    except FileNotFoundError:
+        pass
+    print(f"{queue.worker}: running final step")
+    try:
+        error = run_steps(queue, final_key, [final], {})
+        if error is None:
+            queue.record('done', final_key, 'final')
+            if queue.is_failed(final_key):
+                os.remove(queue.path('failed', final_key))
+        else:
+            print(f"{queue.worker}: final step failed: {error}")
+            queue.record('failed', final_key, error)
+    finally:
+        queue.release(final_key)
+    return error
+
+
+def print_status(run_list, queue_dir):
+    queue = WorkQueue(queue_dir)
+    counts = {'done': 0, 'failed': 0, 'claimed': 0, 'pending': 0}
+    for name, _ in read_run_list(run_list):
+        if queue.is_done(name):
+            counts['done'] += 1
+        elif queue.is_failed(name):
+            counts['failed'] += 1
+        elif os.path.exists(queue.path('claims', name)):
+            counts['claimed'] += 1
+        else:
+            counts['pending'] += 1
+    print(', '.join(f'{n} {kind}' for kind, n in counts.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process a run list with workers on any number of nodes sharing a queue directory.")
+    parser.add_argument('run_list', help='File with one input path per line.')
+    parser.add_argument('--queue_dir', default='queue', help='Shared directory holding the queue state. Default: queue')
+    parser.add_argument('--step', action='append', help='Shell command run for each input, repeatable; {input} is replaced by the quoted input path and {name} by its basename without extension. Default: prepare.py, MuonLArSim and convert_pgun.py as in the shell scripts')
+    parser.add_argument('--final', help='Shell command run once after all inputs are done; a failure gives a nonzero exit status. E.g. "./merge.py --append merged.hdf5 ..."')
+    parser.add_argument('--timeout', type=float, default=600., help='Seconds after which the claim of a silent worker is taken over. Default: 600')
+    parser.add_argument('--poll', type=float, default=10., help='Seconds between looks at claimed items. Default: 10')
+    parser.add_argument('--workers', type=int, default=1, help='Number of local worker processes. Default: 1')
+    parser.add_argument('--retry_failed', action='store_true', help='Queue failed inputs again.')
+    parser.add_argument('--status', action='store_true', help='Print queue counts and exit.')
+    args = parser.parse_args()
+
+    if args.status:
+        print_status(args.run_list, args.queue_dir)
+        return
+    if args.retry_failed:
+        WorkQueue(args.queue_dir).retry_failed()
+    kwargs = dict(steps=args.step, final=args.final, timeout=args.timeout, poll=args.poll)
+    if args.workers == 1:
+        sys.exit(int(work(args.run_list, args.queue_dir, **kwargs) > 0))
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(args.workers) as pool:
+        futures = [pool.submit(work, args.run_list, args.queue_dir, **kwargs)
+                   for _ in range(args.workers)]
+        failed = max(f.result() for f in futures)
+    sys.exit(int(failed > 0))
+
+
+if __name__ == '__main__':
+    main()